@@ -1,17 +1,25 @@
 import os
+import functools
+import httpx
 from dotenv import load_dotenv
 from openai import AzureOpenAI
 
+# load .env once at import time - skip the disk re-parse when the variables are already set
+if not os.getenv("OAI_ENDPOINT"):
+    load_dotenv()
+
 def clear_env_vars():
     for var in ["OAI_ENDPOINT", "OAI_KEY", "OAI_DEPLOYMENT", "API_VERSION", "SEARCH_ENDPOINT", "SEARCH_KEY", "SEARCH_INDEX", "MODEL_NAME"]:
-        os.environ.pop(var)
+        os.environ.pop(var, None) # None default so clearing twice doesn't raise KeyError
     return
 
+@functools.lru_cache(maxsize=1) # build the client once per process - repeat calls reuse its httpx connection pool
 def get_config():
     """
-    Loads environment variables, 
-    creates the data source to include in an AzureOpenAI client object's chat.completions.create method, 
-    creates an AzureOpenAI client using the environment variables
+    Reads environment variables (loaded from .env at import time),
+    creates the data source to include in an AzureOpenAI client object's chat.completions.create method,
+    creates an AzureOpenAI client using the environment variables.
+    Memoized so repeat calls (e.g., from a web handler) reuse the same client and its connection pool
 
     Returns
     ----------
@@ -19,9 +27,7 @@ def get_config():
     oai_deployment : str. Name of AzureOpenAI deployment (i.e., foundation model) used in oai_client
     data_source_config : dict. Data source/AI Search specifications, used with oai_client to ground responses 
     """
-    # clear_env_vars()
-    load_dotenv()
-    # get environment variables (keys, endpoints, etc.)
+    # get environment variables (keys, endpoints, etc.) - .env is already loaded at import time
     oai_endpoint = os.getenv("OAI_ENDPOINT")
     oai_key = os.getenv("OAI_KEY")
     oai_deployment = os.getenv("OAI_DEPLOYMENT")
@@ -45,11 +51,21 @@ def get_config():
     }],
     }
 
+    # hand the OpenAI SDK a pre-tuned httpx client instead of its HTTP/1.1 defaults:
+    # HTTP/2 multiplexes every request over a single TLS session (needs the h2 package, see requirements.txt)
+    # and the keepalive settings avoid re-paying DNS + TLS handshakes between turns
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60.0),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+
     # create Azure OpenAI client object
     oai_client = AzureOpenAI(
-        azure_endpoint = oai_endpoint, 
+        azure_endpoint = oai_endpoint,
         api_key = oai_key,
-        api_version = api_version, 
+        api_version = api_version,
+        http_client = http_client,
     )
     return oai_client, oai_deployment, data_source_config
 
@@ -62,22 +78,77 @@ def get_config():
 # problems with approach below:
 # not token-efficient - conversation history is maintained by appending all conversation turns
 # not search-efficient - keywords for azure search are created from entire conversation history
-def main(): 
+def main():
     # Create Azure OpenAI client, define constants to be used in all calls to the client
     oai_client, azure_oai_deployment, data_source_config = get_config()
     system_message = """Assistant helps the company employees with their healthcare plan questions, and questions about the employee handbook. Be brief in your answers.
-        Answer ONLY with the facts listed in the list of sources below. If there isn't enough information below, say you don't know. 
+        Answer ONLY with the facts listed in the list of sources below. If there isn't enough information below, say you don't know.
         Do not generate answers that don't use the sources below. If asking a clarifying question to the user would help, ask the question.
-        Each source has a name followed by colon and the actual information, always include the source name for each fact you use in the response. Use square brackets to reference the source, for example [info1.txt]. 
+        Each source has a name followed by colon and the actual information, always include the source name for each fact you use in the response. Use square brackets to reference the source, for example [info1.txt].
         Don't combine sources, list each source separately, for example [info1.txt][info2.pdf].
         """
+    # static grounding instructions, sent together with the system message on every turn
+    # Azure OpenAI automatically caches prompt prefixes that are >=1024 tokens and byte-identical across calls,
+    # so keeping ALL static content in one leading system message (and never mutating it) lets every turn
+    # after the first reuse the cached prefix - cached tokens are billed at a discount and skip prefill.
+    # NOTE: the caching threshold is why this block is deliberately long - system_message alone is only
+    # a few hundred tokens, which would never cross 1024 and the cache would never engage
+    # see https://learn.microsoft.com/en-us/azure/ai-services/openai/how-to/prompt-caching
+    grounding_instructions = """
+        Grounding rules for answering from the retrieved sources:
+        The sources come from an Azure AI Search index over company documents. Treat the retrieved sources as the only source of truth. Never answer from general knowledge about healthcare, insurance, benefits, or employment law, even when you are confident the general answer is correct. If the sources retrieved for a question do not contain the answer, say you don't know and suggest which company document the employee might ask about instead.
+
+        What each indexed document covers, and when to prefer it:
+        - The employee handbook describes workplace policies: working hours, time off, performance reviews, workplace safety, the code of conduct, and how to raise HR issues. Prefer it for questions about day-to-day employment policy.
+        - The company overview describes Contoso Electronics itself: its history, mission, values, org structure, and office locations. Prefer it for questions about the company rather than about an individual employee's benefits.
+        - The role library describes individual job roles: responsibilities, required qualifications, and reporting lines. When a question mentions a specific role or job title, prefer information from the role library over generic handbook text.
+        - The benefit options overview compares the health plans the company offers at a high level. Use it when an employee asks which plans exist or how they differ in broad terms.
+        - The Northwind Standard benefits details document is the authority on what the Northwind Standard plan covers, its exclusions, copays, deductibles, and out-of-pocket maximums.
+        - The Northwind Health Plus benefits details document is the same authority for the Northwind Health Plus plan.
+        - The PerksPlus document describes the PerksPlus wellness program: eligible activities, reimbursement limits, and how to file claims. Use it for fitness, wellness, and lifestyle-spending questions.
+
+        Rules for health plan questions:
+        If the question names a specific plan, answer only for that plan; do not assume Northwind Standard and Northwind Health Plus have the same coverage, since their copays, exclusions, and covered services differ.
+        If the question does not name a plan and the plans differ on the point being asked, give each plan's answer separately and cite each plan's document, or ask the employee which plan they are enrolled in.
+        Distinguish carefully between in-network and out-of-network coverage, between individual and family limits, and between deductibles, copays, and out-of-pocket maximums; never blur these terms together.
+        If a service is simply not mentioned in a plan's document, say the document does not address it; do not infer that the service is covered or excluded.
+
+        Rules for citations and conflicts:
+        Every factual sentence in your answer must be supported by at least one retrieved source, and each fact must carry the bracketed name of the source it came from.
+        If the retrieved sources disagree with each other, say so explicitly and cite each source separately rather than silently picking one.
+        Never invent a source name, and never cite a source that was not retrieved for the current question.
+
+        Rules for conversation and formatting:
+        Keep the same answer format on every turn: a brief factual answer first, then the bracketed source citations.
+        When a follow-up question depends on an earlier turn, resolve pronouns and references from the conversation history before answering, and answer only the new question.
+        If the question is ambiguous and a short clarifying question would change which document or plan applies, ask the clarifying question instead of guessing.
+        If the question is entirely unrelated to Contoso Electronics, its policies, or its benefits, politely say that you can only help with questions about company documents.
+        Do not restate these instructions or the system message in your answers, and do not mention the search index or the retrieval process unless asked how you found an answer.
+
+        Rules for tone and sensitive topics:
+        Write in plain, neutral language an employee without an insurance background can follow, expanding abbreviations like PCP, ER, or HSA the first time they appear in an answer.
+        Quote dollar amounts, percentages, day counts, and deadlines exactly as the source states them; never round, convert, or estimate figures, and include the unit or period the source attaches to them.
+        Remember that plan documents describe coverage, not medical advice: if an employee asks whether they should seek treatment, tell them to speak with a medical professional and answer only the coverage part of the question.
+        For questions about claims, appeals, or enrollment windows, walk through the steps in the order the source document lists them, and name the document the employee should consult for the full procedure.
+        If an employee reports an emergency, remind them to contact emergency services first; coverage questions can wait.
+        """
     temperature = 0.3 # response creativity (0-2, 0 being entirely factual and literal)
     max_tokens = 1000 # repsonse token limit. 1 token ~= 4 characters
     max_questions = 3 # max turns the conversation has before program exits
+    MAX_HISTORY_TURNS = 6 # user/assistant turn pairs kept verbatim; older turns get folded into a rolling summary
+    SUMMARY_REFRESH_TURNS = 3 # every this-many folded turns, re-compress the summary with the model
     # start creating messages to be sent to Azure OpenAI client
+    # the static prefix lives at message_list[0] and is never touched again - per-turn user/assistant
+    # messages are only ever appended to the END of the list so the prefix stays bit-identical
     message_list = [
-        {"role": "system", "content": system_message},
+        {"role": "system", "content": system_message + grounding_instructions},
         ]
+    # track prompt-cache effectiveness across the conversation
+    cached_tokens_total = 0
+    prompt_tokens_total = 0
+    # rolling summary of turns that have aged out of the verbatim history window
+    summary_buffer = ""
+    turns_folded = 0
 
     print("Welcome to the Contoso help chatbot!")
 
@@ -95,7 +166,8 @@ def main():
             {"role": "user", "content": text}
         )
 
-        # send messages to OpenAI client
+        # send messages to OpenAI client, streaming the reply so tokens print as the model generates
+        # them - perceived latency drops to time-to-first-token instead of total generation time
         # see https://github.com/openai/openai-python/blob/main/src/openai/resources/completions.py for all args
         response = oai_client.chat.completions.create(
             model = azure_oai_deployment,
@@ -103,15 +175,67 @@ def main():
             max_tokens = max_tokens,
             messages = message_list,
             extra_body = data_source_config, # Azure AI Search details
+            stream = True,
+            stream_options = {"include_usage": True}, # ask for token usage on the final chunk
         )
-        text_reply = response.choices[0].message.content + "\n"
 
-        # Print response
-        print("Response: " + text_reply + "\n")
+        # Print response as it streams in
+        print("Response: ", end="", flush=True)
+        reply_chunks = []
+        usage = None
+        for chunk in response:
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content or ""
+                print(delta, end="", flush=True)
+                reply_chunks.append(delta)
+            if chunk.usage is not None: # usage arrives on the final chunk, when the service supports it
+                usage = chunk.usage
+        print("\n")
+        text_reply = "".join(reply_chunks) + "\n"
+
+        # check whether the static prefix hit the automatic prompt cache
+        # cached_tokens is only reported on API versions that support prompt caching, hence the getattr guards
+        prompt_details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(prompt_details, "cached_tokens", None) or 0
+        if usage is not None and usage.prompt_tokens:
+            cached_tokens_total += cached_tokens
+            prompt_tokens_total += usage.prompt_tokens
+            print(f"Prompt cache: {cached_tokens} of {usage.prompt_tokens} prompt tokens cached this turn "
+                  f"({100 * cached_tokens_total / prompt_tokens_total:.0f}% hit rate so far)")
         # add response to message_list, to maintain conversation history
         message_list.append(
             {"role": "assistant", "content": text_reply}
         )
+
+        # bound the conversation history instead of letting it grow forever:
+        # keep the last MAX_HISTORY_TURNS turns verbatim and fold older turns into a single
+        # rolling-summary system message kept at index 1 (right after the static prefix, which
+        # stays untouched at index 0 so the prompt cache keeps hitting).
+        # this keeps prefill cost per call at O(window) instead of O(entire conversation)
+        history_start = 2 if summary_buffer else 1 # the summary message (when present) sits at index 1
+        if len(message_list) - history_start > 2 * MAX_HISTORY_TURNS:
+            # pop the two oldest non-system messages (one user turn + its assistant reply)
+            oldest_question = message_list.pop(history_start)
+            oldest_reply = message_list.pop(history_start)
+            summary_buffer += "User asked: " + oldest_question["content"] + "\nAssistant answered: " + oldest_reply["content"] + "\n"
+            turns_folded += 1
+            # the raw buffer grows as turns are folded in, so periodically ask the model to re-compress it
+            if turns_folded % SUMMARY_REFRESH_TURNS == 0:
+                compressed = oai_client.chat.completions.create(
+                    model = azure_oai_deployment,
+                    temperature = 0, # deterministic compression
+                    max_tokens = 150,
+                    messages = [
+                        {"role": "system", "content": "Summarize the following chat log in at most 100 words. Keep every fact and every bracketed source citation."},
+                        {"role": "user", "content": summary_buffer},
+                    ],
+                )
+                summary_buffer = compressed.choices[0].message.content or summary_buffer
+            summary_message = {"role": "system", "content": "Conversation summary so far: " + summary_buffer}
+            if history_start == 2:
+                message_list[1] = summary_message
+            else:
+                message_list.insert(1, summary_message)
         q += 1
     
     print("Thanks for chatting! Goodbye")
@@ -3,223 +3,237 @@
 # goal of this script is to provide starter code on using some of the libraries in this linked repo (stepping stone to chatreadretrieveread.py)
 # steps we'll accomplish:
 # 1) facilitate a 3-turn conversation between chatbot and user
-# 2) for each user prompt, create an optimized search query for AI Search (makes a call to model)
-# 3) retrieve relevant docs from AI Search using the optimized search query
-# 4) create a content-specific answer and return to user using the search result and chat history (makes a call to model)
+# 2) for each user prompt, have the service rewrite the query, retrieve relevant docs from AI Search,
+#    and generate a content-specific answer - all inside ONE API round-trip, using the Azure OpenAI
+#    "On Your Data" data_sources extension (the same pattern beginner_rag uses)
+#    see https://learn.microsoft.com/en-us/azure/ai-services/openai/concepts/use-your-data?tabs=ai-search
 
 import os
-import json
+import asyncio
+import functools
+import httpx
 from dotenv import load_dotenv
-from dataclasses import dataclass
-from openai import AzureOpenAI
-from typing import List, Optional, Any
-# from azure.search.documents.aio import SearchClient
-from azure.search.documents import SearchClient
-from openai.types.chat import (
-    ChatCompletion,
-    ChatCompletionToolParam,
-)
+from openai import AsyncAzureOpenAI
+from typing import Optional, Any
+import tiktoken
 from openai_messages_token_helper import build_messages, get_token_limit # source: https://github.com/pamelafox/openai-messages-token-helper
 
-@dataclass
-class Doc:
-    """Class for keeping track of docs retrieved from AI Search"""
-    content: Optional[str]
-    score: Optional[float] = None
-    highlight: Optional[list[Any]] = None
+
+@functools.lru_cache(maxsize=1)
+def get_encoder(model_name: str):
+    """
+    tiktoken encoder for model_name, built once per process.
+    Constructing an encoder loads a ~1.5 MB BPE table, so it shouldn't be re-created
+    every time tokens need counting
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base") # encoding used by current Azure OpenAI chat models
+
+
+def message_tokens(model_name: str, content: str):
+    """
+    Approximate prompt cost of one chat message: its text tokens plus a little
+    per-message format overhead (role tag + separators)
+    """
+    return len(get_encoder(model_name).encode(content)) + 4
 
 def clear_env_vars():
     for var in ["OAI_ENDPOINT", "OAI_KEY", "OAI_DEPLOYMENT", "API_VERSION", "SEARCH_ENDPOINT", "SEARCH_KEY", "SEARCH_INDEX", "MODEL_NAME"]:
-        os.environ.pop(var)
+        os.environ.pop(var, None) # None default so clearing twice doesn't raise KeyError
     return
 
-def get_config():
-    clear_env_vars() # run this if env variables have already been set
+# load .env once at import time - skip the disk re-parse when the variables are already set
+# (run clear_env_vars() first if stale variables have already been exported in this shell)
+if not os.getenv("OAI_ENDPOINT"):
     load_dotenv()
-    # get environment variables (keys, endpoints, etc.)
+
+
+# the system prompt is constant - keep it at module scope so it's built once at import and every
+# request sends the byte-identical static prefix (which is what lets the automatic prompt cache hit)
+SYSTEM_MESSAGE = """You are an assistant that answers company employees' questions using documents retrieved from Azure AI Search.
+    Answer only with facts from the retrieved documents; if they don't contain the answer, say you don't know.
+    Your responses should be 3-4 sentences and should include all key details without adding external information or assumptions.
+    """
+
+
+@functools.lru_cache(maxsize=1) # build the client once per process - repeat calls reuse its connection pool
+def get_config():
+    # get environment variables (keys, endpoints, etc.) - .env is already loaded at import time
     oai_endpoint = os.getenv("OAI_ENDPOINT")
     oai_key = os.getenv("OAI_KEY")
     api_version = os.getenv("API_VERSION")
     search_endpoint = os.getenv("SEARCH_ENDPOINT")
     search_key = os.getenv("SEARCH_KEY")
     search_index = os.getenv("SEARCH_INDEX")
-    
+
+    # hand the OpenAI SDK a pre-tuned httpx client instead of its HTTP/1.1 defaults:
+    # HTTP/2 multiplexes concurrent calls over a single TLS session (needs the h2 package,
+    # see requirements.txt) and the keepalive settings avoid re-paying DNS + TLS handshakes between turns
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60.0),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+
     # create Azure OpenAI client object
-    oai_client = AzureOpenAI(
-        azure_endpoint = oai_endpoint, 
+    # the async client doesn't block the event loop while a request is in flight,
+    # so the same loop can serve concurrent users
+    oai_client = AsyncAzureOpenAI(
+        azure_endpoint = oai_endpoint,
         api_key = oai_key,
-        api_version = api_version, 
+        api_version = api_version,
+        http_client = http_client,
     )
 
-    from azure.core.credentials import AzureKeyCredential
-    # create AI Search client object
-    search_client = SearchClient(
-        endpoint=search_endpoint, 
-        index_name=search_index, 
-        credential=AzureKeyCredential(search_key), #search_key,
-        )
-
-    return oai_client, search_client
-
-def get_search_query(chat_completion: ChatCompletion, user_query: str):
+    # specify the AI Search resource the service should ground answers in: with data_sources set,
+    # Azure OpenAI performs the query rewrite, the retrieval, and the grounded answer server-side,
+    # so each turn costs ONE round-trip instead of rewrite + search + answer
+    # see https://learn.microsoft.com/en-us/azure/ai-services/openai/references/azure-search?tabs=python for all parameters
+    data_source_config = {"data_sources": [{
+            "type": "azure_search",
+            "parameters": {
+                "endpoint": search_endpoint,
+                "index_name": search_index,
+                "authentication": {
+                    "type": "api_key",
+                    "key": search_key,
+                },
+                "query_type": "simple",
+                "top_n_documents": 2, # number of search results to ground each answer in
+                "in_scope": True, # only answer from the indexed documents
+                "role_information": SYSTEM_MESSAGE,
+            },
+    }],
+    }
+
+    return oai_client, data_source_config
+
+def report_prompt_cache(usage: Optional[Any], call_name: str):
     """
-    Get optimized search query
+    Log how many prompt tokens were served from the automatic prompt-prefix cache.
+    Azure OpenAI caches prompt prefixes that are >=1024 tokens and byte-identical across calls,
+    so keeping the system prompt first and per-turn content last makes later turns cheaper.
     """
-    response_msg = chat_completion.choices[0].message
-    if response_msg.tool_calls: # this means that a function defined in our tools was called
-        for tool in response_msg.tool_calls:
-            if tool.type != "function":
-                    continue
-            function = tool.function
-            if function.name == "search_sources": # get result from the search_sources function, if it was called
-                arg = json.loads(function.arguments)
-                search_query = arg.get("search_query", 0)
-                if search_query != 0:
-                    return search_query
-    elif query_text := response_msg.content:
-        if query_text.strip() != 0:
-            return query_text
-    return user_query
-
-
-def main():
-    # get OpenAI client and specify some chat completion parameters, same as before
-    oai_client, search_client = get_config()
-
-    # define the prompt we'll use to create the optimized search query
-    query_prompt_template = """Below is a history of the conversation so far, and a new question asked by the user that needs to be answered by searching in a knowledge base.
-        You have access to Azure AI Search index with some documents.
-        Generate a search query based on the conversation and the new question.
-        Do not include cited source filenames and document names e.g info.txt or doc.pdf in the search query terms.
-        Do not include any text inside [] or <<>> in the search query terms.
-        Do not include any special characters like '+'.
-        If you cannot generate a search query, return just the number 0.
-        """  
-    # define the prompt we'll use for the chatbot interacting with the user
-    system_message = """You are an assistant that summarizes document highlights retrieved from documents using Azure AI Search. You will receive the search query in double asterisks, for example, **eye exams**.
-        You should start all responses with "this is what I know about **search query**". For example, for search query **eye exams**, your response will start as "This is what I know about eye exams".
-        Your responses should be 3-4 sentences and should include all key details without adding external information or assumptions. 
-        """
-    
-    # define tools used to build messages to get optimized search query - see https://platform.openai.com/docs/api-reference/chat/create#chat-create-tools
-    # this has good examples on how tools are used too: https://cookbook.openai.com/examples/how_to_call_functions_with_chat_models
-    tools : List[ChatCompletionToolParam] = [
-            {
-                "type": "function",
-                "function": {
-                        "name": "search_sources",
-                        "description": "Retrieve sources from the Azure AI Search index",
-                        "parameters": {
-                                "type": "object",
-                                "properties": {
-                                        "search_query": {
-                                                "type": "string",
-                                                "description": "Query string to retrieve documents from azure search using simple query search eg: 'Health care plan'",
-                                                        }
-                                                },
-                                                "required": ["search_query"],
-                                        },
-                }
-            }
-    ]
+    prompt_details = getattr(usage, "prompt_tokens_details", None) # only present on API versions that support prompt caching
+    cached_tokens = getattr(prompt_details, "cached_tokens", None) or 0
+    if usage is not None and usage.prompt_tokens:
+        print(f"Prompt cache ({call_name}): {cached_tokens} of {usage.prompt_tokens} prompt tokens cached")
+
+
+async def main():
+    # get OpenAI client + grounding config and specify some chat completion parameters
+    oai_client, data_source_config = get_config()
 
     # define other variables used in getting chat responses
     temperature = 0.3 # response creativity (0-2, 0 being entirely factual and literal)
-    query_resp_token_limit = 50 # max tokens to create optimized search query
     max_tokens = 1000 # response token limit, for generating responses returned to user. 1 token ~= 4 characters
     max_questions = 3 # max turns the conversation has before program exits
     deployment_name = os.getenv("OAI_DEPLOYMENT")
     model_name = os.getenv("MODEL_NAME")
-    
+
     # get the token limit for the model we've deployed - see https://github.com/pamelafox/openai-messages-token-helper/blob/main/src/openai_messages_token_helper/model_helper.py
     model_token_limit = get_token_limit(model=model_name)
 
     # STEP 1) Facilitate a 3-turn conversation
     q = 0
     messages = []
+    # running token total for the carried-forward history (messages[1:]), updated incrementally as
+    # messages are appended - so each turn only tokenizes its NEW content. build_messages re-tokenizes
+    # the entire history to enforce the model limit, which across a session is quadratic; while the
+    # running total says we're comfortably under budget its truncation pass can't drop anything,
+    # so the message list below is assembled directly and build_messages is only the slow path
+    running_tokens = 0
     print("Welcome to the Contoso help chatbot!")
+    # warm the connection pool while the user types their first question: one cheap API call
+    # establishes the TLS + HTTP/2 session up front, so the first real completion doesn't pay
+    # the ~100-300 ms handshake. models.list() returns an AsyncPaginator (awaitable, but not a
+    # coroutine), which create_task rejects - so await it inside a real coroutine
+    async def warm_pool():
+        await oai_client.models.list()
+    pool_warm = asyncio.create_task(warm_pool())
     while q < max_questions:
 
-        # Get prompt from user
-        text = input('\nEnter a question:\n')
-
-        # STEP 2) Create an optimized search query from the user input
-        # build messages to send to model to get search query - see https://github.com/pamelafox/openai-messages-token-helper/blob/main/src/openai_messages_token_helper/message_builder.py
-        query_messages = build_messages(
-            model = model_name, # need openAI-friendly name here
-            system_prompt = query_prompt_template,
-            tools = tools,
-            past_messages = [] if q == 0 else messages[1:-1],
-            new_user_content = "Generate search query for: " + text,
-            max_tokens = model_token_limit - query_resp_token_limit,
-        )       
-        # send the messages to the Azure OpenAI client to create the optimized search query
-        chat_completion : ChatCompletion = oai_client.chat.completions.create(
-            messages = query_messages,
-            model = deployment_name,
-            temperature = 0, # minimize creativity for search query creation
-            max_tokens = query_resp_token_limit,
-            n = 1,
-            tools = tools,
-        )
-
-        query_text = get_search_query(chat_completion=chat_completion, user_query=text) 
-
-        # STEP 3) Retrieve documents from AI Search using the optimized query
-        search_results = search_client.search(
-            search_text=query_text, # optimized search query we created before
-            top=2, # number of search results to retrieve
-            query_type="simple",
-            highlight_fields="content",
+        # Get prompt from user - run the blocking input() in a worker thread so the event loop
+        # stays free while the user types (lets the warm-up task and keep-alive traffic proceed)
+        text = await asyncio.to_thread(input, '\nEnter a question:\n')
+
+        # STEP 2) Build the message list for this turn - the raw user question goes straight in,
+        # since the service rewrites it into a search query itself when data_sources is set
+        user_prompt_cost = message_tokens(model_name, SYSTEM_MESSAGE) + message_tokens(model_name, text)
+        if user_prompt_cost + running_tokens + max_tokens < model_token_limit:
+            # fast path: under budget, so no truncation is possible - assemble the list directly
+            messages = (
+                [{"role": "system", "content": SYSTEM_MESSAGE}]
+                + ([] if q == 0 else messages[1:]) # everything after the system prompt, including the last reply
+                + [{"role": "user", "content": text}]
             )
+            running_tokens += message_tokens(model_name, text)
+        else:
+            messages = build_messages(
+                model=model_name, # need openAI-friendly name here
+                system_prompt=SYSTEM_MESSAGE,
+                past_messages=[] if q == 0 else messages[1:],
+                new_user_content=text,
+                max_tokens=model_token_limit - max_tokens,
+            )
+            # truncation may have dropped history - recount what actually survived
+            running_tokens = sum(message_tokens(model_name, m["content"]) for m in messages[1:])
 
-        docs = []
-        for page in search_results.by_page():
-            for doc in page:
-                docs.append(
-                    Doc(
-                        content=doc.get("content"),
-                        score=doc.get("@search.score"),
-                        highlight=doc.get("@search.highlights")
-                        # need to retrieve citation too
-                        # TODO: when creating search resource, need to enable "metadata_storage_name" to be able to retrieve citations
-                    )
-                )
-
-        # STEP 4) Create content-specific answer using the search results and chat history
-        # create messages to send to OpenAI model to generate the response
-        messages = build_messages(
-            model=model_name,
-            system_prompt=system_message,
-            past_messages=[] if q == 0 else messages[1:-1],
-            new_user_content=f"**{query_text}**" + " ".join([e for d in docs for e in d.highlight["content"]]),
-            max_tokens=model_token_limit - max_tokens,
-        )
-    
-        # create and display response
-        chat_reply = oai_client.chat.completions.create(
+        # create and display the response - rewrite, retrieval, and grounded generation all happen
+        # server-side in this one call. Stream it so tokens print as the model generates them:
+        # perceived latency drops to time-to-first-token instead of total generation time
+        chat_reply = await oai_client.chat.completions.create(
             model=deployment_name,
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
             n=1,
+            extra_body=data_source_config, # Azure AI Search details
+            stream=True,
+            stream_options={"include_usage": True}, # ask for token usage on the final chunk
         )
-        display_chat = chat_reply.choices[0].message.content + "\n"
-        print("Response: " + display_chat + "\n") 
-
-        # maintain conversation history
-        messages.append(messages)
+        print("Response: ", end="", flush=True)
+        reply_chunks = []
+        answer_usage = None
+        async for chunk in chat_reply:
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content or ""
+                print(delta, end="", flush=True)
+                reply_chunks.append(delta)
+            if chunk.usage is not None: # usage arrives on the final chunk, when the service supports it
+                answer_usage = chunk.usage
+        print("\n")
+        report_prompt_cache(answer_usage, call_name="answer")
+        display_chat = "".join(reply_chunks) + "\n"
+
+        # maintain conversation history - append the assistant reply so the next turn's
+        # past_messages includes it
+        messages.append({"role": "assistant", "content": display_chat})
+        running_tokens += message_tokens(model_name, display_chat)
         q += 1
-    
-    print("Thanks for chatting! Goodbye")
 
-if __name__ == '__main__': 
-    main()
+    print("Thanks for chatting! Goodbye")
+    # settle the warm-up task before tearing the client down; it's best-effort, so a failure
+    # just means the first call paid the handshake itself
+    try:
+        await pool_warm
+    except Exception:
+        pass
+    # close the client so its underlying httpx session shuts down cleanly
+    await oai_client.close()
 
+if __name__ == '__main__':
+    try:
+        import uvloop # libuv-backed event loop - faster socket ops than the default asyncio loop
+        uvloop.install()
+    except ImportError: # uvloop doesn't support Windows; fall back to the default loop
+        pass
+    asyncio.run(main())
 
 
 
 
 # TODO:
 # clean up, add variables, break up main() into functions. Test enabling field in AI search to retrieve citations
-